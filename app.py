@@ -3,6 +3,13 @@ Face Approval System - FastAPI Backend
 A secure face recognition platform for member access management
 """
 
+import os
+
+# Motor runs blocking pymongo calls on a thread pool (default 5 x CPUs);
+# must be set before motor is imported. The registered_faces change stream
+# keeps one thread busy in awaitData getMores, so leave room for the rest.
+os.environ.setdefault("MOTOR_MAX_WORKERS", "4")
+
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -10,26 +17,65 @@ from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field, ConfigDict
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from bson import Binary
 from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 from datetime import datetime
 from typing import Optional, List, Dict
 import secrets
-import os
+import hashlib
 import asyncio
+import multiprocessing
 
 # ✅ NEW: Face recognition imports
 import face_recognition
+import dlib
 import cv2
 import numpy as np
 import base64
 from io import BytesIO
 from PIL import Image
 
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    turbo_jpeg = TurboJPEG()
+except Exception:
+    turbo_jpeg = None
+
 # ========== CONFIGURATION ==========
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = "face_approval_system"
 ADMIN_USERNAME = "root"
 ADMIN_PASSWORD = "ssh"
+FACE_ENCODING_DIM = 128
+FACE_MATCH_THRESHOLD = 0.6
+MAX_LOGS = 100
+LOG_COLLECTION_SIZE = 1_000_000  # bytes, capped collection size limit
+LOG_BATCH_SIZE = 50
+LOG_FLUSH_INTERVAL = 0.1  # seconds to wait for more entries before writing a batch
+ENCODING_CACHE_SIZE = 512
+FACE_CACHE_POLL_INTERVAL = 10  # seconds, mirror reload interval without change streams
+CHANGE_STREAM_UNSUPPORTED = 40573  # server error code on standalone (non replica set) MongoDB
+# Face worker processes per app process (multiplied by the number of gunicorn workers).
+# Each worker creates its own CUDA context, so CUDA builds default to one per app process.
+FACE_WORKERS = int(os.getenv("FACE_WORKERS", "1" if dlib.DLIB_USE_CUDA else "2"))
+FACE_DETECTION_MAX_WIDTH = 640  # wider frames are shrunk for detection, encoding stays full resolution
+# CNN detector on CUDA builds of dlib, HOG on CPU. HOG keeps one upsample since
+# it misses faces under ~80px in the detection frame; CNN runs on the full-size
+# frame (no downscale) so it can skip the upsample.
+FACE_DETECTION_MODEL = "cnn" if dlib.DLIB_USE_CUDA else "hog"
+FACE_DETECTION_UPSAMPLE = 0 if dlib.DLIB_USE_CUDA else 1
+
+# Covering index for the admin user list
+USER_LIST_INDEX = [("name", 1), ("class", 1), ("roll", 1), ("code", 1), ("registered_at", 1)]
 
 # ========== PYDANTIC MODELS ==========
 class FaceCaptureRequest(BaseModel):
@@ -86,31 +132,136 @@ in_memory_storage = {
 }
 
 use_mongodb = True
+console_logs_capped = False
+
+# In-process mirror of registered faces (name -> user fields + encoding),
+# updated on register/delete/edit so approve_face never queries MongoDB
+_registered_faces_mirror: Dict[str, Dict] = {}
+_mirror_generation = 0  # bumped on every local register/delete/edit
+_faces_watcher: Optional[asyncio.Task] = None
+
+# Face index built from the mirror
+face_index = None  # faiss.IndexFlatL2 when faiss is installed
+face_index_users: List[Dict] = []
+_enc_matrix: np.ndarray = np.empty((0, FACE_ENCODING_DIM), dtype=np.float32)
+_enc_sqnorms: np.ndarray = np.empty(0, dtype=np.float32)
+
+# Worker pool for CPU-bound face detection/encoding
+face_executor: Optional[ProcessPoolExecutor] = None
+
+# Recently computed encodings keyed by image content hash (LRU)
+_encoding_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+
+# Log entries waiting to be written to MongoDB by the background drainer
+_log_queue: asyncio.Queue = asyncio.Queue()
+_log_drainer: Optional[asyncio.Task] = None
 
 # ========== HELPER FUNCTIONS ==========
 async def log_action(action: str) -> None:
-    """Log action to MongoDB or in-memory storage"""
+    """Queue action for MongoDB or log it to in-memory storage"""
     try:
         timestamp = datetime.now()
         log_entry = {
             "timestamp": timestamp,
             "action": action,
-            "formatted": f"[{timestamp.strftime('%Y-%m-%d %H:%M:%S')}] {action}"
+            "formatted": f"[{timestamp.isoformat(' ', 'seconds')}] {action}"
         }
 
         if use_mongodb and console_logs_collection is not None:
-            await console_logs_collection.insert_one(log_entry)
-            count = await console_logs_collection.count_documents({})
-            if count > 100:
-                oldest_logs = await console_logs_collection.find().sort("timestamp", 1).limit(count - 100).to_list(length=count)
-                for log in oldest_logs:
-                    await console_logs_collection.delete_one({"_id": log["_id"]})
+            _log_queue.put_nowait(log_entry)
         else:
             in_memory_storage['console_logs'].append(log_entry['formatted'])
-            if len(in_memory_storage['console_logs']) > 100:
-                in_memory_storage['console_logs'] = in_memory_storage['console_logs'][-100:]
+            if len(in_memory_storage['console_logs']) > MAX_LOGS:
+                in_memory_storage['console_logs'] = in_memory_storage['console_logs'][-MAX_LOGS:]
+    except Exception as e:
+        print(f"⚠️ Error logging action: {e}")
+
+async def _write_logs(entries: List[Dict]) -> None:
+    """Write a batch of log entries to MongoDB, trimming if the collection is not capped"""
+    try:
+        await console_logs_collection.insert_many(entries, ordered=False)
+        if not console_logs_capped:
+            # Collection metadata only; the MAX_LOGS cap is soft
+            count = await console_logs_collection.estimated_document_count()
+            if count > MAX_LOGS:
+                oldest_logs = await console_logs_collection.find({}, projection={"_id": 1}).sort("timestamp", 1).limit(count - MAX_LOGS).to_list(length=count)
+                await console_logs_collection.delete_many({"_id": {"$in": [log["_id"] for log in oldest_logs]}})
     except Exception as e:
         print(f"⚠️ Error logging action: {e}")
+    finally:
+        for _ in entries:
+            _log_queue.task_done()
+
+async def _drain_logs() -> None:
+    """Background task: batch queued log entries into insert_many calls"""
+    loop = asyncio.get_running_loop()
+    while True:
+        entries = [await _log_queue.get()]
+        deadline = loop.time() + LOG_FLUSH_INTERVAL
+        try:
+            while len(entries) < LOG_BATCH_SIZE:
+                entries.append(await asyncio.wait_for(_log_queue.get(), deadline - loop.time()))
+        except asyncio.TimeoutError:
+            pass
+        await _write_logs(entries)
+
+def decode_face_image(image_bytes: bytes) -> Optional[np.ndarray]:
+    """Decode image bytes straight into an RGB array"""
+    if turbo_jpeg is not None:
+        try:
+            return turbo_jpeg.decode(image_bytes, pixel_format=TJPF_RGB)
+        except OSError:
+            pass  # Not a JPEG, let OpenCV handle it
+
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def _encode_faces(rgb_image: np.ndarray):
+    """Detect faces and encode them if exactly one is found (runs in a worker process)"""
+    scale = 1.0
+    if FACE_DETECTION_MODEL == "hog":
+        scale = max(rgb_image.shape[1] / FACE_DETECTION_MAX_WIDTH, 1.0)
+
+    small_image = rgb_image
+    if scale > 1.0:
+        small_image = cv2.resize(rgb_image, (0, 0), fx=1 / scale, fy=1 / scale)
+
+    face_locations = [
+        (round(top * scale), round(right * scale), round(bottom * scale), round(left * scale))
+        for (top, right, bottom, left) in face_recognition.face_locations(
+            small_image,
+            number_of_times_to_upsample=FACE_DETECTION_UPSAMPLE,
+            model=FACE_DETECTION_MODEL
+        )
+    ]
+    if len(face_locations) != 1:
+        return face_locations, []
+    return face_locations, face_recognition.face_encodings(rgb_image, face_locations)
+
+async def encode_faces(rgb_image: np.ndarray):
+    """Run face detection and encoding off the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(face_executor, _encode_faces, rgb_image)
+
+def _image_cache_key(face_image_data: bytes) -> bytes:
+    """Content hash of the base64 image payload"""
+    # sha256 goes through OpenSSL, which uses SHA-NI / ARMv8 SHA extensions when available
+    return hashlib.sha256(face_image_data).digest()[:16]
+
+def _get_cached_encoding(key: bytes) -> Optional[np.ndarray]:
+    """Look up a previously computed encoding and mark it recently used"""
+    encoding = _encoding_cache.get(key)
+    if encoding is not None:
+        _encoding_cache.move_to_end(key)
+    return encoding
+
+def _cache_encoding(key: bytes, encoding: np.ndarray) -> None:
+    """Remember an encoding, evicting the least recently used one when full"""
+    _encoding_cache[key] = encoding
+    if len(_encoding_cache) > ENCODING_CACHE_SIZE:
+        _encoding_cache.popitem(last=False)
 
 def get_or_create_session_id(request: Request) -> str:
     """Get existing session ID from cookies or create new one"""
@@ -130,17 +281,138 @@ async def clear_temp_face(session_id: str) -> None:
     except Exception as e:
         print(f"⚠️ Error clearing temp face: {e}")
 
+def _load_encoding(stored) -> np.ndarray:
+    """Load a stored face encoding (packed float32 blob, or legacy list of floats)"""
+    if isinstance(stored, bytes):
+        return np.frombuffer(stored, dtype=np.float32)
+    return np.asarray(stored, dtype=np.float32)
+
+def _mirror_user(user: Dict) -> None:
+    """Add or replace a registered user in the in-process mirror"""
+    _registered_faces_mirror[user["name"]] = {
+        "name": user["name"],
+        "class": user["class"],
+        "roll": user["roll"],
+        "code": user["code"],
+        "encoding": _load_encoding(user["face_encoding"])
+    }
+
+def _apply_mirror_change() -> None:
+    """Rebuild the index after a local mirror update and invalidate in-flight reloads"""
+    global _mirror_generation
+    _mirror_generation += 1
+    _rebuild_face_index()
+
+async def _load_registered_faces_mirror() -> None:
+    """Load all registered faces into the in-process mirror and rebuild the index"""
+    global _registered_faces_mirror
+
+    while True:
+        generation = _mirror_generation
+        if use_mongodb and registered_faces_collection is not None:
+            projection = {"name": 1, "class": 1, "roll": 1, "code": 1, "face_encoding": 1, "_id": 0}
+            users = await registered_faces_collection.find({}, projection=projection).to_list(length=None)
+        else:
+            users = list(in_memory_storage['registered_faces'].values())
+
+        # A local register/delete/edit finished during the fetch; the result may
+        # predate it, so fetch again rather than overwrite the newer mirror
+        if generation == _mirror_generation:
+            break
+
+    _registered_faces_mirror = {}
+    for user in users:
+        if "face_encoding" in user:
+            _mirror_user(user)
+    _rebuild_face_index()
+
+async def _poll_registered_faces() -> None:
+    """Periodically reload the mirror when change streams are unavailable"""
+    while True:
+        await asyncio.sleep(FACE_CACHE_POLL_INTERVAL)
+        try:
+            await _load_registered_faces_mirror()
+        except Exception as e:
+            print(f"⚠️ Error reloading face encodings: {e}")
+
+async def _watch_registered_faces() -> None:
+    """Reload the mirror when another process or instance changes registered_faces"""
+    delay = 1
+    while True:
+        try:
+            async with registered_faces_collection.watch() as stream:
+                # try_next opens the stream; reload after it so changes made
+                # before the stream was (re)opened are not missed
+                await stream.try_next()
+                await _load_registered_faces_mirror()
+                delay = 1
+                async for _ in stream:
+                    await _load_registered_faces_mirror()
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_UNSUPPORTED:
+                print(f"⚠️ Change streams unsupported, polling registered faces every {FACE_CACHE_POLL_INTERVAL}s")
+                await _poll_registered_faces()
+                return
+            print(f"⚠️ Registered faces change stream failed, retrying in {delay}s: {e}")
+        except Exception as e:
+            print(f"⚠️ Registered faces change stream failed, retrying in {delay}s: {e}")
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
+def _rebuild_face_index() -> None:
+    """Rebuild the encoding matrix (and FAISS index) from the in-process mirror"""
+    global face_index, face_index_users, _enc_matrix, _enc_sqnorms
+
+    users = list(_registered_faces_mirror.values())
+
+    matrix = np.empty((0, FACE_ENCODING_DIM), dtype=np.float32)
+    if users:
+        matrix = np.stack([user["encoding"] for user in users])
+
+    index = None
+    if faiss is not None:
+        index = faiss.IndexFlatL2(FACE_ENCODING_DIM)
+        if len(matrix):
+            index.add(matrix)
+
+    _enc_matrix = matrix
+    _enc_sqnorms = (matrix * matrix).sum(axis=1)
+    face_index = index
+    face_index_users = [
+        {"name": user["name"], "class": user["class"], "roll": user["roll"], "code": user["code"]}
+        for user in users
+    ]
+
+async def _ensure_capped_logs() -> bool:
+    """Make console_logs a capped collection so MongoDB evicts old logs itself"""
+    try:
+        options = await database["console_logs"].options()
+        if options.get("capped") and options.get("max") == MAX_LOGS:
+            return True
+
+        # convertToCapped cannot set a document limit, and logs are disposable,
+        # so recreate the collection instead of converting it
+        if options:
+            await database.drop_collection("console_logs")
+        await database.create_collection("console_logs", capped=True, size=LOG_COLLECTION_SIZE, max=MAX_LOGS)
+        return True
+    except Exception as e:
+        print(f"⚠️ Could not cap console_logs, trimming manually: {e}")
+        return False
+
 async def initialize_mongodb() -> bool:
     """Initialize MongoDB connection and collections"""
     global mongodb_client, database
     global registered_faces_collection, active_sessions_collection
-    global console_logs_collection, temp_faces_collection
+    global console_logs_collection, temp_faces_collection, console_logs_capped
 
     try:
         mongodb_client = AsyncIOMotorClient(MONGODB_URL, serverSelectionTimeoutMS=5000)
         database = mongodb_client[DATABASE_NAME]
 
         await database.command('ping')
+        console_logs_capped = await _ensure_capped_logs()
 
         registered_faces_collection = database["registered_faces"]
         active_sessions_collection = database["active_sessions"]
@@ -148,6 +420,7 @@ async def initialize_mongodb() -> bool:
         temp_faces_collection = database["temp_faces"]
 
         await registered_faces_collection.create_index("name", unique=True)
+        await registered_faces_collection.create_index(USER_LIST_INDEX)
         await active_sessions_collection.create_index("name", unique=True)
         await active_sessions_collection.create_index("session_id", unique=True)
         await console_logs_collection.create_index("timestamp")
@@ -182,20 +455,37 @@ async def initialize_mongodb() -> bool:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application lifespan"""
-    global use_mongodb
-
+    global use_mongodb, face_executor, _log_drainer, _faces_watcher
+
+    # Workers start lazily, after Motor/pymongo threads exist; forking a threaded
+    # process can deadlock, so start them from a clean forkserver instead
+    face_executor = ProcessPoolExecutor(
+        max_workers=FACE_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver")
+    )
     use_mongodb = await initialize_mongodb()
     if use_mongodb:
+        _log_drainer = asyncio.create_task(_drain_logs())
+    # Let a failed load abort startup rather than serve with an empty mirror
+    await _load_registered_faces_mirror()
+    if use_mongodb:
+        _faces_watcher = asyncio.create_task(_watch_registered_faces())
         await log_action("=== SYSTEM STARTED WITH MONGODB ===")
     else:
         await log_action("=== SYSTEM STARTED WITH IN-MEMORY STORAGE ===")
 
-    yield
-
-    if mongodb_client and use_mongodb:
-        await log_action("=== SYSTEM SHUTDOWN ===")
-        mongodb_client.close()
-        print("\n✅ MongoDB connection closed gracefully\n")
+    try:
+        yield
+    finally:
+        if mongodb_client and use_mongodb:
+            await log_action("=== SYSTEM SHUTDOWN ===")
+            await _log_queue.join()
+            _log_drainer.cancel()
+            _faces_watcher.cancel()
+            mongodb_client.close()
+            print("\n✅ MongoDB connection closed gracefully\n")
+
+        face_executor.shutdown(wait=False, cancel_futures=True)
 
 # ========== FASTAPI APP INITIALIZATION ==========
 app = FastAPI(
@@ -243,49 +533,51 @@ async def capture_face(request: Request, data: FaceCaptureRequest):
             raise HTTPException(status_code=400, detail="Invalid face data - image too small or empty")
 
         try:
-            if "base64," in face_image:
-                face_image_data = face_image.split("base64,")[1]
-            else:
-                face_image_data = face_image
+            face_image_data = (face_image.partition("base64,")[2] or face_image).encode("ascii")
+        except UnicodeEncodeError as decode_error:
+            await log_action(f"ERROR: Image decode failed - {str(decode_error)}")
+            raise HTTPException(status_code=400, detail=f"Image decoding error: {str(decode_error)}")
 
-            image_bytes = base64.b64decode(face_image_data)
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        cache_key = _image_cache_key(face_image_data)
+        current_face_encoding = _get_cached_encoding(cache_key)
 
-            if image is None:
-                raise HTTPException(status_code=400, detail="Failed to decode image. Please try capturing again.")
+        if current_face_encoding is None:
+            try:
+                rgb_image = decode_face_image(base64.b64decode(face_image_data))
 
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                if rgb_image is None:
+                    raise HTTPException(status_code=400, detail="Failed to decode image. Please try capturing again.")
 
-        except Exception as decode_error:
-            await log_action(f"ERROR: Image decode failed - {str(decode_error)}")
-            raise HTTPException(status_code=400, detail=f"Image decoding error: {str(decode_error)}")
+            except Exception as decode_error:
+                await log_action(f"ERROR: Image decode failed - {str(decode_error)}")
+                raise HTTPException(status_code=400, detail=f"Image decoding error: {str(decode_error)}")
 
-        # ✅ Detect faces
-        face_locations = face_recognition.face_locations(rgb_image)
+            # ✅ Detect faces and extract encoding
+            face_locations, face_encodings = await encode_faces(rgb_image)
 
-        if len(face_locations) == 0:
-            await log_action("ERROR: No face detected in captured image")
-            raise HTTPException(
-                status_code=400,
-                detail="No face detected in the image. Please ensure your face is clearly visible, well-lit, and centered in the camera."
-            )
+            if len(face_locations) == 0:
+                await log_action("ERROR: No face detected in captured image")
+                raise HTTPException(
+                    status_code=400,
+                    detail="No face detected in the image. Please ensure your face is clearly visible, well-lit, and centered in the camera."
+                )
 
-        if len(face_locations) > 1:
-            await log_action(f"WARNING: Multiple faces detected ({len(face_locations)})")
-            raise HTTPException(
-                status_code=400,
-                detail=f"Multiple faces detected ({len(face_locations)}). Please ensure only one person is in frame."
-            )
+            if len(face_locations) > 1:
+                await log_action(f"WARNING: Multiple faces detected ({len(face_locations)})")
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Multiple faces detected ({len(face_locations)}). Please ensure only one person is in frame."
+                )
 
-        # ✅ Extract face encoding
-        face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
+            if len(face_encodings) == 0:
+                await log_action("ERROR: Failed to generate face encoding")
+                raise HTTPException(status_code=400, detail="Failed to process face. Please try again with better lighting.")
 
-        if len(face_encodings) == 0:
-            await log_action("ERROR: Failed to generate face encoding")
-            raise HTTPException(status_code=400, detail="Failed to process face. Please try again with better lighting.")
+            current_face_encoding = face_encodings[0]
+            _cache_encoding(cache_key, current_face_encoding)
 
-        face_encoding = face_encodings[0].tolist()
+        # ✅ Store encoding as a packed 128 x float32 blob
+        face_encoding = Binary(np.asarray(current_face_encoding, dtype=np.float32).tobytes())
         session_id = get_or_create_session_id(request)
 
         # ✅ Store both image and encoding
@@ -381,7 +673,6 @@ async def register_entry(request: Request, data: RegisterEntryRequest):
         user_document = {
             "name": name,
             "face_encoding": face_encoding,
-            "face_image_preview": face_data[:500],
             "class": class_name,
             "roll": roll,
             "code": code,
@@ -393,6 +684,8 @@ async def register_entry(request: Request, data: RegisterEntryRequest):
         else:
             in_memory_storage['registered_faces'][name] = user_document
 
+        _mirror_user(user_document)
+        _apply_mirror_change()
         await clear_temp_face(session_id)
         await log_action(f"✅ NEW REGISTRATION: {name} | Class: {class_name} | Roll: {roll} | Code: {code}")
 
@@ -414,63 +707,62 @@ async def approve_face(data: ApproveFaceRequest):
             raise HTTPException(status_code=400, detail="Invalid face data received")
 
         try:
-            if "base64," in face_image:
-                face_image_data = face_image.split("base64,")[1]
-            else:
-                face_image_data = face_image
-
-            image_bytes = base64.b64decode(face_image_data)
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            face_image_data = (face_image.partition("base64,")[2] or face_image).encode("ascii")
+        except UnicodeEncodeError as decode_error:
+            await log_action(f"ERROR: Image decode failed - {str(decode_error)}")
+            raise HTTPException(status_code=400, detail=f"Image decoding error: {str(decode_error)}")
 
-            if image is None:
-                raise HTTPException(status_code=400, detail="Failed to decode image")
+        cache_key = _image_cache_key(face_image_data)
+        current_face_encoding = _get_cached_encoding(cache_key)
 
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if current_face_encoding is None:
+            try:
+                rgb_image = decode_face_image(base64.b64decode(face_image_data))
 
-        except Exception as decode_error:
-            await log_action(f"ERROR: Image decode failed - {str(decode_error)}")
-            raise HTTPException(status_code=400, detail=f"Image decoding error: {str(decode_error)}")
+                if rgb_image is None:
+                    raise HTTPException(status_code=400, detail="Failed to decode image")
 
-        face_locations = face_recognition.face_locations(rgb_image)
+            except Exception as decode_error:
+                await log_action(f"ERROR: Image decode failed - {str(decode_error)}")
+                raise HTTPException(status_code=400, detail=f"Image decoding error: {str(decode_error)}")
 
-        if len(face_locations) == 0:
-            await log_action("ERROR: No face detected for approval")
-            raise HTTPException(status_code=400, detail="No face detected. Please position your face clearly in front of the camera.")
+            face_locations, face_encodings = await encode_faces(rgb_image)
 
-        if len(face_locations) > 1:
-            await log_action(f"WARNING: Multiple faces detected ({len(face_locations)}) for approval")
-            raise HTTPException(status_code=400, detail=f"Multiple faces detected. Only one person should be in frame.")
+            if len(face_locations) == 0:
+                await log_action("ERROR: No face detected for approval")
+                raise HTTPException(status_code=400, detail="No face detected. Please position your face clearly in front of the camera.")
 
-        face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
+            if len(face_locations) > 1:
+                await log_action(f"WARNING: Multiple faces detected ({len(face_locations)}) for approval")
+                raise HTTPException(status_code=400, detail=f"Multiple faces detected. Only one person should be in frame.")
 
-        if len(face_encodings) == 0:
-            raise HTTPException(status_code=400, detail="Failed to process face")
+            if len(face_encodings) == 0:
+                raise HTTPException(status_code=400, detail="Failed to process face")
 
-        current_face_encoding = face_encodings[0]
+            current_face_encoding = face_encodings[0]
+            _cache_encoding(cache_key, current_face_encoding)
 
         # ✅ Compare with registered faces
         matched_user = None
         best_match_distance = 1.0
 
-        if use_mongodb and registered_faces_collection is not None:
-            async for user in registered_faces_collection.find():
-                if "face_encoding" in user:
-                    stored_encoding = np.array(user["face_encoding"])
-                    face_distance = face_recognition.face_distance([stored_encoding], current_face_encoding)[0]
-
-                    if face_distance < 0.6 and face_distance < best_match_distance:
-                        best_match_distance = face_distance
-                        matched_user = user
-        else:
-            for name, user in in_memory_storage['registered_faces'].items():
-                if "face_encoding" in user:
-                    stored_encoding = np.array(user["face_encoding"])
-                    face_distance = face_recognition.face_distance([stored_encoding], current_face_encoding)[0]
+        if face_index_users:
+            query = np.asarray(current_face_encoding, dtype=np.float32)
 
-                    if face_distance < 0.6 and face_distance < best_match_distance:
-                        best_match_distance = face_distance
-                        matched_user = user
+            if face_index is not None:
+                # IndexFlatL2 returns squared L2 distances
+                distances, indices = face_index.search(query[None, :], 1)
+                best_index = int(indices[0, 0])
+                best_distance = float(np.sqrt(distances[0, 0]))
+            else:
+                # ||a - q||^2 = ||a||^2 + ||q||^2 - 2 a.q, one matrix-vector product per query
+                distances_sq = _enc_sqnorms + query @ query - 2 * (_enc_matrix @ query)
+                best_index = int(distances_sq.argmin())
+                best_distance = float(np.sqrt(max(distances_sq[best_index], 0.0)))
+
+            if best_distance < FACE_MATCH_THRESHOLD:
+                best_match_distance = best_distance
+                matched_user = face_index_users[best_index]
 
         if not matched_user:
             await log_action("❌ APPROVAL DENIED: Face not recognized")
@@ -489,8 +781,8 @@ async def approve_face(data: ApproveFaceRequest):
         }
 
         if use_mongodb and active_sessions_collection is not None:
-            await active_sessions_collection.delete_many({"name": matched_user["name"]})
-            await active_sessions_collection.insert_one(session_data)
+            # One session per user, enforced by the unique index on "name"
+            await active_sessions_collection.replace_one({"name": matched_user["name"]}, session_data, upsert=True)
         else:
             to_remove = [sid for sid, sess in in_memory_storage['active_sessions'].items() 
                         if sess.get('name') == matched_user["name"]]
@@ -525,9 +817,8 @@ async def get_session(session_id: str):
     """Get active session information"""
     try:
         if use_mongodb and active_sessions_collection is not None:
-            session = await active_sessions_collection.find_one({"session_id": session_id})
+            session = await active_sessions_collection.find_one({"session_id": session_id}, projection={"_id": 0})
             if session:
-                session['_id'] = str(session['_id'])
                 session['start_time'] = session['start_time'].isoformat()
                 return session
         else:
@@ -589,7 +880,9 @@ async def get_all_users():
         users = []
 
         if use_mongodb and registered_faces_collection is not None:
-            async for user in registered_faces_collection.find():
+            projection = {"name": 1, "class": 1, "roll": 1, "code": 1, "registered_at": 1, "_id": 0}
+            user_docs = await registered_faces_collection.find({}, projection=projection).hint(USER_LIST_INDEX).to_list(length=None)
+            for user in user_docs:
                 users.append({
                     "name": user["name"],
                     "class": user["class"],
@@ -618,10 +911,11 @@ async def get_logs():
         logs = []
 
         if use_mongodb and console_logs_collection is not None:
-            async for log in console_logs_collection.find().sort("timestamp", -1).limit(100):
-                logs.append(log["formatted"])
+            sort_key = "$natural" if console_logs_capped else "timestamp"
+            log_docs = await console_logs_collection.find({}, projection={"formatted": 1, "_id": 0}).sort(sort_key, -1).limit(MAX_LOGS).to_list(length=MAX_LOGS)
+            logs = [log["formatted"] for log in log_docs]
         else:
-            logs = list(reversed(in_memory_storage['console_logs'][-100:]))
+            logs = list(reversed(in_memory_storage['console_logs'][-MAX_LOGS:]))
 
         return {"logs": logs}
     except Exception as e:
@@ -643,6 +937,8 @@ async def delete_user(data: DeleteUserRequest):
             else:
                 raise HTTPException(status_code=404, detail="User not found")
 
+        _registered_faces_mirror.pop(name, None)
+        _apply_mirror_change()
         await log_action(f"🗑️ USER DELETED: {name}")
         return {"success": True, "message": f"User '{name}' deleted successfully"}
     except HTTPException:
@@ -663,19 +959,19 @@ async def edit_user(data: EditUserRequest):
             raise HTTPException(status_code=400, detail="All fields are required")
 
         if use_mongodb and registered_faces_collection is not None:
-            user = await registered_faces_collection.find_one({"name": old_name})
+            # A rename onto an existing name is rejected by the unique index on "name"
+            try:
+                user = await registered_faces_collection.find_one_and_update(
+                    {"name": old_name},
+                    {"$set": {"name": new_name, "class": new_class, "roll": new_roll}},
+                    projection={"_id": 1},
+                    return_document=ReturnDocument.BEFORE
+                )
+            except DuplicateKeyError:
+                raise HTTPException(status_code=400, detail=f"User '{new_name}' already exists")
+
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
-
-            if old_name != new_name:
-                existing = await registered_faces_collection.find_one({"name": new_name})
-                if existing:
-                    raise HTTPException(status_code=400, detail=f"User '{new_name}' already exists")
-
-            await registered_faces_collection.update_one(
-                {"name": old_name},
-                {"$set": {"name": new_name, "class": new_class, "roll": new_roll}}
-            )
         else:
             if old_name not in in_memory_storage['registered_faces']:
                 raise HTTPException(status_code=404, detail="User not found")
@@ -692,6 +988,11 @@ async def edit_user(data: EditUserRequest):
                 in_memory_storage['registered_faces'][new_name] = user
                 del in_memory_storage['registered_faces'][old_name]
 
+        mirrored_user = _registered_faces_mirror.pop(old_name, None)
+        if mirrored_user is not None:
+            mirrored_user.update({"name": new_name, "class": new_class, "roll": new_roll})
+            _registered_faces_mirror[new_name] = mirrored_user
+        _apply_mirror_change()
         await log_action(f"✏️ USER EDITED: {old_name} → {new_name} | Class: {new_class} | Roll: {new_roll}")
         return {"success": True, "message": "User updated successfully"}
     except HTTPException: